@@ -35,24 +35,29 @@ __email__ = "noahvc619@gmail.com"
 
 __version__ = "1.0.3"
 
-import io
 import chess
-import chess.pgn
 import keyboard
 import pyautogui
+import sys
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from stockfish import Stockfish
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.remote.webelement import WebElement
 
+# Moves are timed by the drag durations below, not by pyautogui's pause between calls
+pyautogui.PAUSE = 0
+
 class ChessBot:
     """
     A bot that plays chess on Lichess using Stockfish for move calculation.
-    Interacts with the web interface using Selenium and pyautogui to execute moves.
+    Interacts with the web interface using Selenium, and either Chrome DevTools
+    input events or pyautogui to execute moves.
     """
     URL = "https://lichess.org"
     STOCKFISH_PATH = "your/stockfish/path"
@@ -64,18 +69,64 @@ class ChessBot:
         'bottom_time': '//*[@id="main-wrap"]/main/div[1]/div[8]/div[2]',
         'clock': '//*[@id="main-wrap"]/main/div[1]/div[7]'
     }
+    # Installed on every new document, logs MOVE_TOKEN whenever the move list changes
+    MOVE_TOKEN = "__chessbot_move__"
+    MOVE_OBSERVER_SCRIPT = """
+        new MutationObserver(function (mutations) {
+            for (const mutation of mutations) {
+                const node = mutation.target.nodeType === 1 ? mutation.target : mutation.target.parentElement;
+                if (node && node.closest('rm6')) {
+                    console.debug('__chessbot_move__');
+                    return;
+                }
+            }
+        }).observe(document, {childList: true, subtree: true, characterData: true});
+    """
+    # Reads the move list and both clocks in a single round-trip
+    GAME_STATE_SCRIPT = """
+        const find = (xpath) => document.evaluate(xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        const parent = find(arguments[0]);
+        const top = find(arguments[1]);
+        const bottom = find(arguments[2]);
+        const moves = parent ? Array.from(parent.querySelectorAll('*')) : [];
+        return [moves, moves.map(move => move.innerText), top && top.innerText, bottom && bottom.innerText];
+    """
+    # Rank offsets of the promotion choices, counted from the promotion square
+    _PROMO_OFFSETS_WHITE = {"q": 0, "n": -1, "r": -2, "b": -3}
+    _PROMO_OFFSETS_BLACK = {"q": 0, "n": 1, "r": 2, "b": 3}
     # Tweak these settings as you see fit
     DRAG_DURATION_SHORT = 0
     DRAG_DURATION_LONG = 0.3
+    PROMOTION_DELAY = 0.1
+    # Drive the mouse through Chrome DevTools instead of moving the real cursor with pyautogui
+    USE_CDP_INPUT = True
+    LISTENER_INTERVAL = 0.05
+    TURN_POLL_INTERVAL = 0.02
+    TRANSPOSITION_TABLE_SIZE = 4096
+    # Board and piece sets are SVG, so only raster images and fonts are blocked
+    BLOCKED_URLS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.woff", "*.woff2"]
 
     def __init__(self) -> None:
         """
         Initializes the ChessBot by setting up the webdriver, Stockfish engine,
         and starting the browser worker thread.
         """
-        self.driver = self.initialize_webdriver()
-        self.stockfish = self.initialize_stockfish()
+        # Stockfish can allocate its hash table while Chrome is starting
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            driver_future = executor.submit(self.initialize_webdriver)
+            stockfish_future = executor.submit(self.initialize_stockfish)
+            self.driver = driver_future.result()
+            self.stockfish = stockfish_future.result()
         self.wait = WebDriverWait(self.driver, 1)
+        self.board = chess.Board()
+        self.uci_moves: list[str] = []
+        self._sf_plies_sent = 0
+        self._tt: OrderedDict[tuple, str] = OrderedDict()
+        self._turn_event = threading.Event()
+        self._driver_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.listening = False
+        self.initialize_move_listener()
         self.color = None
         self.flag = False
         self.track_clock = False
@@ -91,8 +142,9 @@ class ChessBot:
         self.wait_for_esc()
         
     def wait_for_esc(self) -> None:
-        """Waits for the ESC key to be pressed to exit the program."""
-        keyboard.wait('esc')
+        """Waits for the ESC key to be pressed, or for the worker thread to stop, to exit the program."""
+        keyboard.on_press_key('esc', lambda _: self._stop.set())
+        self._stop.wait()
         self.exit_program()
         
     def initialize_webdriver(self) -> webdriver.Chrome:
@@ -103,9 +155,47 @@ class ChessBot:
         """
         options = webdriver.ChromeOptions()
         options.add_argument("--disable-extensions")
+        options.page_load_strategy = "eager"
+        options.set_capability("goog:loggingPrefs", {"browser": "ALL"})
         driver = webdriver.Chrome(options=options)
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": self.BLOCKED_URLS})
         return driver
 
+    def initialize_move_listener(self) -> None:
+        """
+        Installs a MutationObserver on the move list through the Chrome DevTools Protocol
+        and starts a thread that turns its console messages into turn events.
+        Leaves self.listening False if polling has to be used instead.
+        """
+        try:
+            self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": self.MOVE_OBSERVER_SCRIPT})
+            self.driver.execute_cdp_cmd("Runtime.enable", {})
+        except Exception as e:
+            print(f"Move listener unavailable, falling back to polling: {e}")
+            return
+        self.listening = True
+        self.listener_thread = threading.Thread(target=self.listen_for_moves)
+        self.listener_thread.daemon = True
+        self.listener_thread.start()
+
+    def listen_for_moves(self) -> None:
+        """
+        Sets the turn event whenever the move observer reports a change in the move list.
+        Falls back to polling if the browser log can no longer be read.
+        """
+        while True:
+            try:
+                with self._driver_lock:
+                    entries = self.driver.get_log("browser")
+            except Exception:
+                self.listening = False
+                self._turn_event.set()
+                return
+            if any(self.MOVE_TOKEN in entry["message"] for entry in entries):
+                self._turn_event.set()
+            time.sleep(self.LISTENER_INTERVAL)
+
     def initialize_stockfish(self) -> Stockfish:
         """
         Initializes the Stockfish engine with specified parameters.
@@ -131,18 +221,28 @@ class ChessBot:
         return stockfish
     
     def exit_program(self) -> None:
-        """Exits the program by closing the WebDriver and quitting the script."""
+        """
+        Exits the program by stopping the worker thread, closing the WebDriver and quitting the script.
+        The WebDriver is only closed once no other thread is using it.
+        """
         print("\nExiting the program.")
-        self.driver.quit()
-        quit()
+        self.flag = True
+        self._stop.set()
+        self._turn_event.set()
+        self.worker_thread.join(timeout=1.0)
+        with self._driver_lock:
+            self.driver.quit()
+        sys.exit(0)
         
     def initialize_browser(self) -> None:
         """Loads the Lichess website and starts the game loop."""
-        self.driver.get(self.URL)
+        with self._driver_lock:
+            self.driver.get(self.URL)
         try:
             self.gameloop()
         except Exception as e:
             print(f"An error has occured: {e}")
+        self._stop.set()
 
     def determine_color(self, ranks: WebElement) -> str:
         """
@@ -152,52 +252,62 @@ class ChessBot:
         Returns:
             str: "black" if playing as black, "white" otherwise.
         """
-        class_name = ranks.get_attribute("class")
+        with self._driver_lock:
+            class_name = ranks.get_attribute("class")
         if class_name == "ranks black":
             print("Playing as black"); return "black"
         print("Playing as white"); return "white"
     
-    def wait_for_ranks(self) -> WebElement:
+    def wait_for_ranks(self) -> WebElement | None:
         """
-        Waits until the ranks element is present on the page.
+        Waits until the ranks element is present on the page, or until the program is exiting.
         Returns:
-            WebElement: The ranks element.
+            WebElement: The ranks element, None if the program is exiting.
         """
-        while True:
+        while not self.flag and not self._stop.is_set():
             try:
                 return self.wait_for_element("ranks")
             except Exception:
                 pass
+        return None
                 
     def initialize_game(self) -> None:
         """
         Initializes the game state by determining player color, checking if the game is timed,
         and setting up the initial board state. Executes the opening move if applicable.
         """
-        self.moves_elements = []
+        self._seen_ids: set[str] = set()
         self.moves = []
         self.time = False
+        self.wtime = None
+        self.btime = None
+        self.moved_at = None
+        self._turn_event.clear()
+        self.board.reset()
+        self.uci_moves = []
+        self._sf_plies_sent = 0
         ranks = self.wait_for_ranks()
+        if ranks is None:
+            return
         clock = self.wait_for_element('clock')
-        self.time = len(clock.find_elements(By.XPATH, ".//*")) > 1; print(f"Game is {'timed' if self.time else 'not timed'}!")
+        with self._driver_lock:
+            self.time = self.driver.execute_script('return arguments[0].childElementCount > 1;', clock)
+        print(f"Game is {'timed' if self.time else 'not timed'}!")
         self.color = self.determine_color(ranks)
         self.get_board_coords()
 
         if not self.bongcloud:
             if self.color == "white":
                 self.execute_move("e2e4")
+            else:
+                self._turn_event.set()
             self.stockfish.set_position()
         else:
+            self._turn_event.set()
             self.execute_bongcloud_moves()
             self.get_moves()
-            pgn_string = " ".join(self.moves)
-            pgn = chess.pgn.read_game(io.StringIO(pgn_string))
-            board = chess.Board()
-            moves = []
-            for move in pgn.mainline_moves():
-                board.push(move)
-                moves.append(str(move))
-            self.stockfish.set_position(moves[:-1])
+            self.stockfish.set_position(self.uci_moves)
+            self._sf_plies_sent = len(self.uci_moves)
 
     def execute_bongcloud_moves(self) -> None:
         """
@@ -209,40 +319,56 @@ class ChessBot:
         else:
             moves = ["e7e6", "e8e7", "e7e8"]
         for move in moves:
-            while not self.is_turn() and not self.flag:
-                pass
+            self.wait_for_turn()
             if self.flag:
                 break
             self.execute_move(move)
 
     def get_moves(self) -> None:
-        """Fetches the latest moves from the game and updates the move list."""
+        """Fetches the latest moves from the game and updates the move list and board."""
         try:
-            parent_moves_element = self.wait_for_element("parent_moves")
+            with self._driver_lock:
+                new_moves, texts, top_time, bottom_time = self.driver.execute_script(
+                    self.GAME_STATE_SCRIPT, self.XPATHS['parent_moves'], self.XPATHS['top_time'], self.XPATHS['bottom_time']
+                )
+            filtered_new_moves = [(move, text) for move, text in zip(new_moves, texts) if move.id not in self._seen_ids]
+            self._seen_ids.update(move.id for move, _ in filtered_new_moves)
+            self.moves.extend(text for _, text in filtered_new_moves if text and not text[0].isdigit())
+            self.update_board()
             if self.time and self.track_clock:
-                self.update_clock_times()
-            new_moves = parent_moves_element.find_elements(By.XPATH, ".//*")
-            filtered_new_moves = [move for move in new_moves if move not in self.moves_elements]
-            self.moves_elements.extend(filtered_new_moves)
-            self.moves.extend([move.text + "." if move.text.isdigit() else move.text for move in filtered_new_moves])
+                self.update_clock_times(top_time, bottom_time)
         except Exception:
             pass
         
-    def update_clock_times(self) -> None:
-        """Updates the clock times for both players if the game is timed."""
-        try:
-            top_time = self.wait_for_element('top_time').text
-            bottom_time = self.wait_for_element('bottom_time').text
-            if self.color == "white":
-                btime = top_time.replace("\n", "")
-                wtime = bottom_time.replace("\n", "")
-            else:
-                wtime = top_time.replace("\n", "")
-                btime = bottom_time.replace("\n", "")
-            self.wtime = (int(wtime[:wtime.index(":")])*60 + int(wtime[wtime.index(":")+1:]))*1000
-            self.btime = (int(btime[:btime.index(":")])*60 + int(btime[btime.index(":")+1:]))*1000
-        except TimeoutException:
-            pass
+    def update_clock_times(self, top_time: str | None, bottom_time: str | None) -> None:
+        """
+        Updates the clock times for both players if the game is timed.
+        Args:
+            top_time (str): The text of the top clock, None if it is not on the page.
+            bottom_time (str): The text of the bottom clock, None if it is not on the page.
+        """
+        if top_time is None or bottom_time is None:
+            return
+        if self.color == "white":
+            btime = top_time.replace("\n", "")
+            wtime = bottom_time.replace("\n", "")
+        else:
+            wtime = top_time.replace("\n", "")
+            btime = bottom_time.replace("\n", "")
+        self.wtime = self._parse_clock(wtime)
+        self.btime = self._parse_clock(btime)
+
+    @staticmethod
+    def _parse_clock(clock: str) -> int:
+        """
+        Converts a clock string to milliseconds.
+        Args:
+            clock (str): The clock text (e.g., '03:25' or '00:09.3').
+        Returns:
+            int: The remaining time in milliseconds.
+        """
+        minutes, _, seconds = clock.partition(":")
+        return (int(minutes)*60 + int(float(seconds)))*1000
         
     def handle_end_game(self) -> bool:
         """
@@ -274,7 +400,13 @@ class ChessBot:
         Returns:
             bool: True if it's the bot's turn, False otherwise.
         """
+        if self.listening and not self._turn_event.is_set():
+            return False
+        self._turn_event.clear()
         self.get_moves()
+        # Our last move has not shown up in the move list yet
+        if len(self.moves) == self.moved_at:
+            return False
         if not self.moves:
             if self.color == "black":
                 return False
@@ -283,6 +415,16 @@ class ChessBot:
             return False
         return self.determine_turn()
 
+    def wait_for_turn(self) -> None:
+        """
+        Blocks until it's the bot's turn or the game is over. Sleeps on the turn event
+        between checks, and polls every TURN_POLL_INTERVAL when the move listener is unavailable.
+        """
+        while not self.flag:
+            self._turn_event.wait(timeout=None if self.listening else self.TURN_POLL_INTERVAL)
+            if self.is_turn():
+                break
+
     def determine_turn(self) -> bool:
         """
         Determines if it's the bot's turn based on the current move list.
@@ -290,39 +432,71 @@ class ChessBot:
             bool: True if it's the bot's turn, False otherwise.
         """
         if self.color == "white":
-            return (len(self.moves) % 3 == 0)
+            return len(self.moves) % 2 == 0
         else:
-            return ((len(self.moves)-2) % 3 == 0)
+            return len(self.moves) % 2 == 1
+
+    def update_board(self) -> None:
+        """Pushes the SAN moves that are not on the board yet and records them in UCI format."""
+        for san in self.moves[len(self.uci_moves):]:
+            try:
+                move = self.board.push_san(san)
+            except ValueError:
+                break
+            self.uci_moves.append(move.uci())
 
     def get_next_move(self) -> None:
         """
         Determines the best move using Stockfish and executes it on the board.
         """
-        pgn_string = " ".join(self.moves)
-        pgn = chess.pgn.read_game(io.StringIO(pgn_string))
-        board = chess.Board()
-        moves = []
-        for move in pgn.mainline_moves():
-            board.push(move)
-            if len(moves) >= 2:
-                moves.pop(0)
-            moves.append(str(move))
         try:
-            self.stockfish.make_moves_from_current_position(moves)
+            if self._sf_plies_sent < len(self.uci_moves):
+                self.stockfish.make_moves_from_current_position(self.uci_moves[self._sf_plies_sent:])
+                self._sf_plies_sent = len(self.uci_moves)
         except ValueError:
-            print("pyautogui needs a moment..")
-        best_move = self.stockfish.get_best_move_time(10)
+            print("Stockfish fell out of sync, resending the game..")
+            self.stockfish.set_position(self.uci_moves)
+            self._sf_plies_sent = len(self.uci_moves)
+        best_move = self.get_best_move()
         if best_move:
             self.execute_move(str(best_move))
         else:
             self.flag = True
 
+    def get_best_move(self) -> str | None:
+        """
+        Looks up the best move for the current position, only asking Stockfish
+        if the position is not in the transposition table yet. Stockfish searches
+        to its configured depth, or manages its own time when the clocks are tracked.
+        Returns:
+            str: The best move in UCI format, None if there is no legal move.
+        """
+        key = self.board._transposition_key()
+        best_move = self._tt.get(key)
+        if best_move is not None:
+            self._tt.move_to_end(key)
+            return best_move
+        best_move = self.stockfish.get_best_move(wtime=self.wtime, btime=self.btime)
+        if best_move:
+            self._tt[key] = best_move
+            if len(self._tt) > self.TRANSPOSITION_TABLE_SIZE:
+                self._tt.popitem(last=False)
+        return best_move
+
     def get_board_coords(self) -> None:
         """Calculates and stores the board coordinates for each square."""
         element = self.wait_for_element('board')
-        element_x, element_y = element.location.values()
-        height, width = element.size.values()
-        abs_x, abs_y = [a + b for a, b in zip((element_x, element_y), [self.driver.execute_script(f'return window.outer{word} - window.inner{word};') for word in ["Width", "Height"]])]
+        with self._driver_lock:
+            element_x, element_y, width, height, offset_x, offset_y = self.driver.execute_script(
+                'const rect = arguments[0].getBoundingClientRect();'
+                'return [rect.left, rect.top, rect.width, rect.height,'
+                ' window.outerWidth - window.innerWidth, window.outerHeight - window.innerHeight];',
+                element
+            )
+        if self.USE_CDP_INPUT:
+            abs_x, abs_y = element_x, element_y
+        else:
+            abs_x, abs_y = element_x + offset_x, element_y + offset_y
         files = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
         ranks = [1, 2, 3, 4, 5, 6, 7, 8]
         self.positions = self.calculate_positions(files, ranks, abs_x, abs_y, width, height)
@@ -346,40 +520,65 @@ class ChessBot:
             width (int): The width of the board.
             height (int): The height of the board.
         Returns:
-            dict: A dictionary mapping square names (e.g., 'e2') to screen coordinates (x, y).
+            dict: A dictionary mapping square names (e.g., 'e2') to screen coordinates (x, y),
+                  and promotion moves (e.g., 'e8n') to the coordinates of the piece to pick.
         """
+        sx, sy = width / 8, height / 8
+        ox, oy = sx / 2 + abs_x, sy / 2 + abs_y
         if self.color == "white":
-            return {
-                f'{file}{rank}': (
-                    round((width / 8) * files.index(file) + (width / 8) / 2 + abs_x),
-                    round((height / 8) * (8 - rank) + (height / 8) / 2 + abs_y)
-                )
-                for file in files for rank in ranks
+            positions = {
+                f'{file}{rank}': (round(sx * fi + ox), round(sy * (7 - ri) + oy))
+                for fi, file in enumerate(files) for ri, rank in enumerate(ranks)
             }
         else:
-            return {
-                f'{file}{rank}': (
-                    round((width / 8) * list(reversed(files)).index(file) + (width / 8) / 2 + abs_x),
-                    round((height / 8) * (rank - 1) + (height / 8) / 2 + abs_y)
-                )
-                for file in list(reversed(files)) for rank in ranks
+            positions = {
+                f'{file}{rank}': (round(sx * fi + ox), round(sy * ri + oy))
+                for fi, file in enumerate(reversed(files)) for ri, rank in enumerate(ranks)
             }
+        if self.color == "white":
+            promotion_rank, offsets = 8, self._PROMO_OFFSETS_WHITE
+        else:
+            promotion_rank, offsets = 1, self._PROMO_OFFSETS_BLACK
+        for file in files:
+            for piece, offset in offsets.items():
+                positions[f'{file}{promotion_rank}{piece}'] = positions[f'{file}{promotion_rank + offset}']
+        return positions
 
     def execute_move(self, move: str) -> None:
         """
-        Executes the given move on the board using pyautogui.
+        Executes the given move on the board using Chrome DevTools input events or pyautogui.
         Args:
             move (str): The move in UCI format (e.g., 'e2e4').
         """
+        self.moved_at = len(self.moves)
         from_x, from_y = self.positions[move[:2]]
         to_x, to_y = self.positions[move[2:4]]
-        pyautogui.moveTo(x=from_x, y=from_y)
-        if move[-1].isdigit():
-            pyautogui.dragTo(x=to_x, y=to_y, duration=self.DRAG_DURATION_LONG if self.show_move else self.DRAG_DURATION_SHORT, button="secondary" if self.show_move else "primary")
+        if self.USE_CDP_INPUT:
+            self.dispatch_mouse([(from_x, from_y), (to_x, to_y)], button="right" if self.show_move else "left")
         else:
+            pyautogui.moveTo(x=from_x, y=from_y)
             pyautogui.dragTo(x=to_x, y=to_y, duration=self.DRAG_DURATION_LONG if self.show_move else self.DRAG_DURATION_SHORT, button="secondary" if self.show_move else "primary")
+        if not move[-1].isdigit():
             self.handle_promotion(move)
 
+    def dispatch_mouse(self, points: list[tuple[int, int]], button: str = "left") -> None:
+        """
+        Presses the mouse at the first point, moves it through the others and releases it at the last one,
+        using Chrome DevTools input events. A single point results in a click.
+        Args:
+            points (list): The viewport coordinates (x, y) to go through.
+            button (str): The mouse button to hold, "left" or "right".
+        """
+        buttons = 1 if button == "left" else 2
+        events = [("mousePressed", points[0], buttons)]
+        events += [("mouseMoved", point, buttons) for point in points[1:]]
+        events.append(("mouseReleased", points[-1], 0))
+        with self._driver_lock:
+            for event_type, (x, y), pressed in events:
+                self.driver.execute_cdp_cmd("Input.dispatchMouseEvent", {
+                    "type": event_type, "x": x, "y": y, "button": button, "buttons": pressed, "clickCount": 1
+                })
+
     def handle_promotion(self, move: str) -> None:
         """
         Handles pawn promotion by selecting the appropriate piece.
@@ -387,35 +586,39 @@ class ChessBot:
             move (str): The move in UCI format including promotion (e.g., 'e7e8q').
         """
         if move[-1] in "qnrb":
-            move_adjustments = {"q": 0,"n": -1,"r": -2,"b": -3}
-            adjustment = move_adjustments.get(move[-1], 0)
-            
-            if self.color == "black":
-                adjustment = -adjustment
-                
-            adjusted_rank = str(int(move[3]) + adjustment)
-            promotion_position = f"{move[2]}{adjusted_rank}"
-            pyautogui.click(y=self.positions[promotion_position][1])
+            time.sleep(self.PROMOTION_DELAY)
+            if self.USE_CDP_INPUT:
+                self.dispatch_mouse([self.positions[move[2:]]])
+            else:
+                pyautogui.click(y=self.positions[move[2:]][1])
 
     def wait_for_element(self, xpath_key: str) -> WebElement:
         """
         Waits until an element specified by its XPath key is present on the page.
+        The driver lock is only held during each lookup, not while waiting between them.
         Args:
             xpath_key (str): The key for the desired element in the XPATHS dictionary.
         Returns:
             WebElement: The desired web element.
         """
-        return self.wait.until(EC.presence_of_element_located((By.XPATH, self.XPATHS[xpath_key])))
+        is_present = EC.presence_of_element_located((By.XPATH, self.XPATHS[xpath_key]))
+
+        def find_element(driver: webdriver.Chrome) -> WebElement:
+            with self._driver_lock:
+                return is_present(driver)
+
+        return self.wait.until(find_element)
 
     def gameloop(self) -> None:
         """Main game loop that initializes the game and handles moves until the game ends."""
-        while True:
+        while not self._stop.is_set():
             self.initialize_game()
             while not self.flag:
-                while not self.is_turn() and not self.flag:
-                    pass
+                self.wait_for_turn()
                 if not self.flag:
                     self.get_next_move()
+            if self._stop.is_set():
+                break
             self.handle_user_input()
 
     def handle_user_input(self) -> None: